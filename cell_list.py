@@ -0,0 +1,91 @@
+#!/usr/bin/python3
+#
+#  Simulate and display movement of particles in a system
+#  Copyright (C) 2024  Marco Leogrande
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# This module requires `numba`: it is only used by the compiled
+# version of the engine.
+
+import itertools
+import kernels
+import numpy as np
+from typing import Tuple
+
+
+class CellList:
+    """Uniform grid that buckets particles by position.
+
+    Space is divided into hypercubes ("cells") with side
+    `cell_size`. Two particles that are at most `cell_size` apart are
+    always either in the same cell or in adjacent cells, so the
+    candidate neighbors of any particle can be found by only looking
+    at the 3^d cells around it, instead of at every other particle.
+    """
+
+    def __init__(self, p: np.typing.NDArray, cell_size: float):
+        if cell_size <= 0:
+            raise ValueError("Invalid cell size: {}".format(cell_size))
+        number_of_points, dimensions = p.shape
+        self._dimensions = dimensions
+        # Integer coordinates of the cell each particle belongs to.
+        # This is a (n, d) matrix.
+        cells = np.floor(p / cell_size).astype(np.int64)
+        # Sort particles by cell, in lexicographic order of the cell
+        # coordinates, so that all particles in the same cell are
+        # contiguous. Only occupied cells are tracked: the grid is
+        # never built, so its size (which can be huge for sparse
+        # systems) does not matter.
+        #
+        # For each occupied cell `m`, the particles it contains are
+        # `self._order[self._cell_starts[m]:self._cell_starts[m + 1]]`.
+        self._order = np.lexsort(cells.T[::-1])
+        sorted_cells = cells[self._order]
+        is_first = np.ones(number_of_points, dtype=bool)
+        is_first[1:] = np.any(sorted_cells[1:] != sorted_cells[:-1], axis=1)
+        # This is a (m, d) matrix, also in lexicographic order.
+        self._occupied_cells = sorted_cells[is_first]
+        self._cell_starts = np.append(np.flatnonzero(is_first), number_of_points)
+
+    @property
+    def order(self) -> np.typing.NDArray:
+        """(n,) indices of all particles, sorted by cell."""
+        return self._order
+
+    def neighbor_ranges(self) -> Tuple[np.typing.NDArray, np.typing.NDArray]:
+        """Returns where to find the particles around each particle.
+
+        The result is a tuple `(starts, ends)` of two (n, 3^d)
+        arrays: for each particle `x` and each cell `c` around it
+        (including its own), the particles in that cell are
+        `self.order[starts[x, c]:ends[x, c]]`. Cells that are empty
+        have `starts[x, c] == ends[x, c]`.
+        """
+        offsets = np.array(
+            list(itertools.product((-1, 0, 1), repeat=self._dimensions)),
+            dtype=np.int64,
+        )
+        starts = np.empty((self._order.shape[0], offsets.shape[0]), dtype=np.int64)
+        ends = np.empty_like(starts)
+        kernels.neighbor_ranges(
+            self._occupied_cells,
+            self._cell_starts,
+            self._order,
+            offsets,
+            starts,
+            ends,
+        )
+        return starts, ends
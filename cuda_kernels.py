@@ -0,0 +1,278 @@
+#!/usr/bin/python3
+#
+#  Simulate and display movement of particles in a system
+#  Copyright (C) 2024  Marco Leogrande
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# GPU version of the particle step. This module requires `numba`
+# and, to be of any use, a CUDA-capable device; the engine only uses
+# it when explicitly asked to.
+#
+# Note that each particle is compared to every other particle, while
+# the CPU kernels only look at the particles in the neighboring cells:
+# for large, sparse systems, the CPU can be faster.
+
+import math
+import numpy as np
+from numba import cuda, float32
+from numba.cuda.random import (
+    create_xoroshiro128p_states,
+    xoroshiro128p_uniform_float32,
+)
+from randomizer import EPSILON, SEED
+
+# Only positions with up to this many dimensions fit into the shared
+# memory tiles.
+MAX_DIMENSIONS = 3
+# Threads per block. Each thread handles one particle, and loads one
+# position of each tile.
+BLOCK = 128
+TILE = BLOCK
+
+
+def is_available() -> bool:
+    return cuda.is_available()
+
+
+@cuda.jit
+def _urgencies_kernel(p, pred_p, uw, eps, u, d_max, u2_dopt, u3_dmax):
+    """Calculate the three urgencies of each particle into `u`.
+
+    This follows the usual tiling of n-body problems: the positions
+    of all particles are walked in tiles of `TILE` positions, which
+    all threads of a block cooperatively load into shared memory, and
+    then read from there.
+
+    All particle matrices are in "structure of arrays" layout (see
+    `DeviceState`).
+    """
+    tile = cuda.shared.array((TILE, MAX_DIMENSIONS), float32)
+    p_i = cuda.local.array(MAX_DIMENSIONS, float32)
+    baricenter = cuda.local.array(MAX_DIMENSIONS, float32)
+    repulsion = cuda.local.array(MAX_DIMENSIONS, float32)
+    dimensions, number_of_points = p.shape
+    i = cuda.grid(1)
+    is_particle = i < number_of_points
+    for k in range(dimensions):
+        p_i[k] = 0.0
+        if is_particle:
+            p_i[k] = p[k, i]
+        baricenter[k] = 0.0
+        repulsion[k] = 0.0
+    count = 0
+    # Scalar arguments come in as double precision: all math is kept
+    # in single precision, which is much faster on most GPUs, by
+    # converting them (and all constants) explicitly.
+    zero = float32(0.0)
+    d_max_sq = float32(d_max * d_max)
+    u2_dopt = float32(u2_dopt)
+    u2_dopt_sq = u2_dopt * u2_dopt
+    u3_dmax = float32(u3_dmax)
+    u3_dmax_sq = u3_dmax * u3_dmax
+
+    for tile_start in range(0, number_of_points, TILE):
+        # All threads need to take part in loading the tile, even the
+        # ones past the last particle.
+        j = tile_start + cuda.threadIdx.x
+        if j < number_of_points:
+            for k in range(dimensions):
+                tile[cuda.threadIdx.x, k] = p[k, j]
+        cuda.syncthreads()
+        if is_particle:
+            for t in range(min(TILE, number_of_points - tile_start)):
+                sq_distance = zero
+                for k in range(dimensions):
+                    diff = p_i[k] - tile[t, k]
+                    sq_distance += diff * diff
+                if sq_distance > zero and sq_distance <= d_max_sq:
+                    count += 1
+                    for k in range(dimensions):
+                        baricenter[k] += tile[t, k]
+                if sq_distance > zero and sq_distance <= u2_dopt_sq:
+                    distance = math.sqrt(sq_distance)
+                    weight = (u2_dopt - distance) / (u2_dopt * distance)
+                    for k in range(dimensions):
+                        repulsion[k] += weight * (p_i[k] - tile[t, k])
+        cuda.syncthreads()
+
+    if not is_particle:
+        return
+    # Particles with no other particle in range see a baricenter in
+    # the origin.
+    inv_count = float32(1.0) / float32(count) if count > 0 else zero
+    for k in range(dimensions):
+        u[0, k, i] = (baricenter[k] * inv_count - p_i[k]) * eps[0, k, i] * uw[0, i]
+        u[1, k, i] = repulsion[k] * eps[1, k, i] * uw[1, i]
+        u[2, k, i] = zero
+    # There are usually very few predators, so they are read directly
+    # from global memory.
+    for q in range(pred_p.shape[0]):
+        sq_distance = zero
+        for k in range(dimensions):
+            diff = p_i[k] - pred_p[q, k]
+            sq_distance += diff * diff
+        if sq_distance > zero and sq_distance <= u3_dmax_sq:
+            distance = math.sqrt(sq_distance)
+            weight = (u3_dmax - distance) / (u3_dmax * distance)
+            for k in range(dimensions):
+                u[2, k, i] += weight * (p_i[k] - pred_p[q, k])
+    for k in range(dimensions):
+        u[2, k, i] *= eps[2, k, i] * uw[2, i]
+
+
+@cuda.jit
+def _epsilon_kernel(rng_states, eps):
+    """Fill `eps` with new epsilons, see `Randomizer.fill_epsilon_matrix`.
+
+    Each thread draws all the epsilons of one particle, from its own
+    random number generator.
+    """
+    i = cuda.grid(1)
+    if i >= eps.shape[2]:
+        return
+    for m in range(eps.shape[0]):
+        for k in range(eps.shape[1]):
+            eps[m, k, i] = float32(1.0 - EPSILON) + float32(
+                2 * EPSILON
+            ) * xoroshiro128p_uniform_float32(rng_states, i)
+
+
+@cuda.jit
+def _integrate_kernel(p, v, a, eps, u, u_to_a, a_max, v_max, v_decay_factor, timestep):
+    """Edit acceleration, velocity and position of each particle."""
+    dimensions, number_of_points = p.shape
+    i = cuda.grid(1)
+    if i >= number_of_points:
+        return
+    # As in `_urgencies_kernel`, all math is in single precision.
+    u_to_a = float32(u_to_a)
+    a_max = float32(a_max)
+    v_max = float32(v_max)
+    v_decay_factor = float32(v_decay_factor)
+    timestep = float32(timestep)
+    sum_of_squares = float32(0.0)
+    for k in range(dimensions):
+        a[k, i] = (u[0, k, i] + u[1, k, i] + u[2, k, i]) * u_to_a
+        sum_of_squares += a[k, i] * a[k, i]
+    # Rows longer than a_max are scaled down to a_max.
+    # Only those are divided, so that zero rows stay zero when the
+    # limit is 0.
+    norm = math.sqrt(sum_of_squares)
+    scale = float32(1.0) if norm <= a_max else a_max / norm
+    sum_of_squares = float32(0.0)
+    for k in range(dimensions):
+        a[k, i] *= scale * eps[3, k, i]
+        v[k, i] = v[k, i] * v_decay_factor + a[k, i] * timestep
+        sum_of_squares += v[k, i] * v[k, i]
+    # Rows longer than v_max are scaled down to v_max.
+    norm = math.sqrt(sum_of_squares)
+    scale = float32(1.0) if norm <= v_max else v_max / norm
+    for k in range(dimensions):
+        v[k, i] *= scale
+        p[k, i] += v[k, i] * timestep
+
+
+class DeviceState:
+    """Particle state that is kept in device memory across steps.
+
+    Positions, velocities and accelerations are only copied back to
+    the host on request, through `copy_to_host`. The epsilons are also
+    drawn on the device, so that they never need to be uploaded.
+
+    On the device, all per-particle matrices are stored transposed,
+    in "structure of arrays" layout (e.g. positions are (d, n)
+    instead of (n, d)): this way, consecutive threads read and write
+    consecutive addresses.
+    """
+
+    def __init__(
+        self,
+        p: np.typing.NDArray,
+        v: np.typing.NDArray,
+        a: np.typing.NDArray,
+        uw: np.typing.NDArray,
+    ):
+        if p.shape[1] > MAX_DIMENSIONS:
+            raise ValueError("Unsupported dimensions: {}".format(p.shape[1]))
+        self.p = cuda.to_device(np.ascontiguousarray(p.T))
+        self.v = cuda.to_device(np.ascontiguousarray(v.T))
+        self.a = cuda.to_device(np.ascontiguousarray(a.T))
+        self.uw = cuda.to_device(np.ascontiguousarray(uw.T))
+        # The shape is (urgencies_count, dimensions_count, particles_count).
+        self.u = cuda.device_array((3,) + self.p.shape, dtype=p.dtype)
+        # The shape is (4, dimensions_count, particles_count), with the
+        # epsilon for the three urgencies and for the final acceleration.
+        self.eps = cuda.device_array((4,) + self.p.shape, dtype=p.dtype)
+        self.rng_states = create_xoroshiro128p_states(self.p.shape[1], seed=SEED)
+
+    def step_particles(
+        self,
+        pred_p: np.typing.NDArray,
+        *,
+        d_max: float,
+        u2_dopt: float,
+        u3_dmax: float,
+        u_to_a: float,
+        a_max: float,
+        v_max: float,
+        v_decay_factor: float,
+        timestep: float
+    ):
+        """Same as `kernels.step_particles`, but on the device.
+
+        Predators are stepped on the host, so their (few) positions
+        are uploaded at each step.
+        """
+        grid = (self.p.shape[1] + BLOCK - 1) // BLOCK
+        d_pred_p = cuda.to_device(pred_p)
+        _epsilon_kernel[grid, BLOCK](self.rng_states, self.eps)
+        _urgencies_kernel[grid, BLOCK](
+            self.p,
+            d_pred_p,
+            self.uw,
+            self.eps,
+            self.u,
+            d_max,
+            u2_dopt,
+            u3_dmax,
+        )
+        _integrate_kernel[grid, BLOCK](
+            self.p,
+            self.v,
+            self.a,
+            self.eps,
+            self.u,
+            u_to_a,
+            a_max,
+            v_max,
+            v_decay_factor,
+            timestep,
+        )
+
+    def copy_to_host(self):
+        """Returns host copies of the positions, velocities and accelerations."""
+        return (
+            np.ascontiguousarray(self.p.copy_to_host().T),
+            np.ascontiguousarray(self.v.copy_to_host().T),
+            np.ascontiguousarray(self.a.copy_to_host().T),
+        )
+
+    def copy_urgencies_to_host(self):
+        """Returns a host copy of the urgencies of the last step.
+
+        The shape is (urgencies_count, particles_count, dimensions_count).
+        """
+        return np.ascontiguousarray(self.u.copy_to_host().transpose(0, 2, 1))
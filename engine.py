@@ -18,13 +18,28 @@
 #
 
 import attrs
-import copy
 import math
 import numpy as np
-import scipy
+import scipy.spatial
 from util import Utils
 from randomizer import Randomizer
-from typing import List, Optional
+from typing import Callable, List, Optional
+
+try:
+    import kernels
+    from cell_list import CellList
+except ImportError:
+    # Without numba, only the (slower) numpy implementation is available.
+    kernels = None
+try:
+    import cuda_kernels
+except ImportError:
+    cuda_kernels = None
+
+# All particle matrices are stored in single precision: this is more
+# than enough for the simulation and its rendering, and it halves the
+# memory moved around at each step.
+DTYPE = np.float32
 
 
 @attrs.define
@@ -58,23 +73,80 @@ class Config:
 
 @attrs.frozen(kw_only=True)
 class EngineRunResult:
-    # Snapshots of the various states the engine ran through.
-    states: List[State]
+    # Snapshots of the various states the engine ran through, in a
+    # single contiguous buffer with shape (snapshots_count, 3,
+    # particles_count, dimensions_count): the second axis is position,
+    # velocity and acceleration, in this order.
+    particles: np.typing.NDArray
+    # Same as above, for predators.
+    predators: np.typing.NDArray
     # Optionally, the urgency vectors for each step the engine ran
     # through. Each step is represented in an array with shape
     # (urgencies_count, particles_count, dimensions_count).
     urgencies: Optional[List[np.typing.NDArray]]
 
+    def state(self, idx: int) -> State:
+        """Returns the `idx`-th snapshot, as views into the buffers."""
+        return State(
+            p=self.particles[idx, 0],
+            v=self.particles[idx, 1],
+            a=self.particles[idx, 2],
+            pred_p=self.predators[idx, 0],
+            pred_v=self.predators[idx, 1],
+            pred_a=self.predators[idx, 2],
+        )
+
+    @property
+    def states(self) -> List[State]:
+        """Returns all snapshots, see `state`."""
+        return [self.state(idx) for idx in range(self.particles.shape[0])]
+
+
+@attrs.frozen(kw_only=True)
+class _ScratchBuffers:
+    # Matrices with the same shape at every step, allocated once and
+    # overwritten by each step instead of being allocated again.
+    pred_diff: np.typing.NDArray  # (n, p)
+    pred_sq_distances: np.typing.NDArray  # (n, p)
+    pred_distances: np.typing.NDArray  # (n, p)
+    pred_weights: np.typing.NDArray  # (n, p)
+    pred_in_range: np.typing.NDArray  # (n, p), boolean
+    pred_mask: np.typing.NDArray  # (n, p), boolean
+    sorted_p: np.typing.NDArray  # (d, n)
+    eps: np.typing.NDArray  # (4, n, d), epsilon for each urgency and the acceleration
+    urgencies: np.typing.NDArray  # (3, n, d)
+
+
+@attrs.frozen(kw_only=True)
+class _StepConstants:
+    # Values derived from the config and the timestep, which do not
+    # change across the steps of a run.
+    timestep: float
+    v_decay: float  # velocity decay over one timestep, i.e. v_decay**timestep
+    u_to_a: float  # factor that converts an urgency into an acceleration
+
 
 class Engine:
     _state: State
     _cfg: Config
     _rand: Randomizer
-
-    def __init__(self, state: State, cfg: Config):
-        self._state = state
-        self._cfg = cfg
-        self._rand = Randomizer()
+    _uw: np.typing.NDArray
+    _scratch: "_ScratchBuffers"
+    _step_kernel: "Optional[Callable]"
+    _device: "Optional[cuda_kernels.DeviceState]"
+
+    def __init__(self, state: State, cfg: Config, *, use_gpu: bool = False):
+        self._state = attrs.evolve(
+            state,
+            p=state.p.astype(DTYPE, copy=False),
+            v=state.v.astype(DTYPE, copy=False),
+            a=state.a.astype(DTYPE, copy=False),
+            pred_p=state.pred_p.astype(DTYPE, copy=False),
+            pred_v=state.pred_v.astype(DTYPE, copy=False),
+            pred_a=state.pred_a.astype(DTYPE, copy=False),
+        )
+        self._cfg = attrs.evolve(cfg, uw=cfg.uw.astype(DTYPE, copy=False))
+        self._rand = Randomizer(dtype=DTYPE)
 
         ## sanity checks
         if (
@@ -91,6 +163,47 @@ class Engine:
                 )
             )
 
+        # Each urgency component is always multiplied by both its
+        # per-individual weight and its species-wide linear parameter,
+        # so they are combined once here. This is a (n, 3) matrix.
+        self._uw = self._cfg.uw * np.array(
+            [self._cfg.u1_p, self._cfg.u2_p, self._cfg.u3_p], dtype=DTYPE
+        )
+
+        number_of_points, dimensions = self._state.p.shape
+        pred_shape = (number_of_points, self._state.pred_p.shape[0])
+        self._scratch = _ScratchBuffers(
+            pred_diff=np.empty(pred_shape, dtype=DTYPE),
+            pred_sq_distances=np.empty(pred_shape, dtype=DTYPE),
+            pred_distances=np.empty(pred_shape, dtype=DTYPE),
+            pred_weights=np.empty(pred_shape, dtype=DTYPE),
+            pred_in_range=np.empty(pred_shape, dtype=bool),
+            pred_mask=np.empty(pred_shape, dtype=bool),
+            sorted_p=np.empty((dimensions, number_of_points), dtype=DTYPE),
+            eps=np.empty((4, number_of_points, dimensions), dtype=DTYPE),
+            urgencies=np.empty((3, number_of_points, dimensions), dtype=DTYPE),
+        )
+
+        # The compiled kernel, if any, is specialized for the most
+        # common numbers of dimensions.
+        self._step_kernel = None
+        if kernels is not None:
+            self._step_kernel = {
+                2: kernels.step_particles_2d,
+                3: kernels.step_particles_3d,
+            }.get(dimensions, kernels.step_particles)
+
+        # On request, particles are simulated on the GPU. In that case
+        # the particle state lives in device memory, and `self._state`
+        # is only updated by `_sync_state`.
+        self._device = None
+        if use_gpu:
+            if cuda_kernels is None or not cuda_kernels.is_available():
+                raise ValueError("No GPU available")
+            self._device = cuda_kernels.DeviceState(
+                self._state.p, self._state.v, self._state.a, self._uw
+            )
+
     def run(
         self,
         *,
@@ -101,19 +214,37 @@ class Engine:
     ) -> EngineRunResult:
         """Run the simulation, return a snapshot of all states."""
         print("Starting simulation with {} iterations ...".format(iterations))
+        # The math works so that skip_initial_states=i will skip the
+        # initial state and the (i-1) states after that; negative
+        # values skip nothing, just like 0.
+        snapshots_count = max(iterations + 1 - max(skip_initial_states, 0), 0)
+        # Snapshots are copied into buffers allocated once, see
+        # `EngineRunResult`.
+        particles = np.empty((snapshots_count, 3) + self._state.p.shape, dtype=DTYPE)
+        predators = np.empty(
+            (snapshots_count, 3) + self._state.pred_p.shape, dtype=DTYPE
+        )
+        snapshot_idx = 0
+        consts = _StepConstants(
+            timestep=timestep,
+            v_decay=math.pow(self._cfg.v_decay, timestep),
+            u_to_a=self._cfg.a_max / self._cfg.u_max,
+        )
         if skip_initial_states > 0:
             print(
                 "(the first {} iterations will be simulated but not returned into the state vector)".format(
                     skip_initial_states
                 )
             )
-            states = []
             urgency_vectors = []
         else:
-            states = [copy.deepcopy(self._state)]
+            self._take_snapshot(particles, predators, snapshot_idx)
+            snapshot_idx += 1
             # The shape is (urgencies_count, particles_count, dimensions_count).
             urgency_vectors = [
-                np.zeros((3, self._state.p.shape[0], self._state.p.shape[1]))
+                np.zeros(
+                    (3, self._state.p.shape[0], self._state.p.shape[1]), dtype=DTYPE
+                )
             ]
 
         for iteration in range(1, iterations + 1):
@@ -122,42 +253,142 @@ class Engine:
                     "\rSimulating iteration {}/{}".format(iteration, iterations), end=""
                 )
 
-            urgencies = self._step_particles(timestep, return_urgency_vectors)
+            urgencies = self._step_particles(consts, return_urgency_vectors)
             self._step_predators(timestep)
             if iteration > (skip_initial_states - 1):
-                # The math works so that skip_initial_states=i will
-                # skip the initial state and the (i-1) states after
-                # that (hence the -1).
-                states.append(copy.deepcopy(self._state))
+                # Same math as above (hence the -1).
+                self._take_snapshot(particles, predators, snapshot_idx)
+                snapshot_idx += 1
                 if return_urgency_vectors:
                     urgency_vectors.append(urgencies)
 
         print()
+        self._sync_state()
         return EngineRunResult(
-            states=states, urgencies=urgency_vectors if return_urgency_vectors else None
+            particles=particles,
+            predators=predators,
+            urgencies=urgency_vectors if return_urgency_vectors else None,
         )
 
-    def _step_particles(self, timestep: float, return_urgency_vectors: bool):
+    def _take_snapshot(self, particles, predators, idx: int):
+        """Copy the current state into the `idx`-th snapshot."""
+        self._sync_state()
+        particles[idx, 0] = self._state.p
+        particles[idx, 1] = self._state.v
+        particles[idx, 2] = self._state.a
+        predators[idx, 0] = self._state.pred_p
+        predators[idx, 1] = self._state.pred_v
+        predators[idx, 2] = self._state.pred_a
+
+    def _sync_state(self):
+        """Copy the particle state back from the GPU, if it is there."""
+        if self._device is not None:
+            self._state.p, self._state.v, self._state.a = self._device.copy_to_host()
+
+    def _step_particles(self, consts: _StepConstants, return_urgency_vectors: bool):
         """Execute one step of the simulation for all particles."""
-        distances = scipy.spatial.distance.squareform(
-            scipy.spatial.distance.pdist(self._state.p)
-        )
-        # Calculate every single urgency
-        u1 = self._calculate_urgency1(distances)
-        u2 = self._calculate_urgency2(distances)
-        u3 = self._calculate_urgency3(distances)
+        if self._device is not None:
+            return self._step_particles_cuda(consts, return_urgency_vectors)
+        # Draw the epsilon for the three urgencies and for the final
+        # acceleration at once.
+        self._rand.fill_epsilon_matrix(self._scratch.eps)
+        if self._step_kernel is not None:
+            return self._step_particles_compiled(consts, return_urgency_vectors)
+        # Only particles that are at most `d_max` or `u2_dopt` apart
+        # can affect one another, so there is no need to compute the
+        # distances between all pairs of particles: a k-d tree finds
+        # all pairs in range in O((n + k) log n) time. Each pair is
+        # only returned once, as `(i, j)` with `i < j`; this is a
+        # (2, k) matrix.
+        tree = scipy.spatial.cKDTree(self._state.p)
+        pairs = tree.query_pairs(
+            r=max(self._cfg.d_max, self._cfg.u2_dopt), output_type="ndarray"
+        ).T
+        # The (k, d) distance vectors between the particles of each
+        # pair are computed once here, and shared by all urgencies.
+        distance_vectors = self._state.p[pairs[0]] - self._state.p[pairs[1]]
+        # This is a (k,) vector, with one squared distance per
+        # pair. Squared distances are enough to tell whether two
+        # particles are in range of each urgency, so the square root
+        # is only taken where it is actually needed.
+        sq_distances = np.einsum("ij,ij->i", distance_vectors, distance_vectors)
+        # Calculate every single urgency, each into its own slice of
+        # the (3, n, d) scratch buffer.
+        urgencies = self._scratch.urgencies
+        self._calculate_urgency1(pairs, distance_vectors, sq_distances, urgencies[0])
+        self._calculate_urgency2(pairs, distance_vectors, sq_distances, urgencies[1])
+        self._calculate_urgency3(pairs, distance_vectors, sq_distances, urgencies[2])
         # Calculate and clip the total urgency
-        u_tot = u1 + u2 + u3
-        self._state.a = u_tot / self._cfg.u_max * self._cfg.a_max
+        np.sum(urgencies, axis=0, out=self._state.a)
+        self._state.a *= consts.u_to_a
         Utils.inplace_clip_by_abs(self._state.a, self._cfg.a_max)
         # Add epsilon uncertainty to final acceleration matrix
-        self._state.a *= self._rand.gen_epsilon_matrix(self._state.a.shape)
+        self._state.a *= self._scratch.eps[3]
         # Edit velocity and position state accordingly
-        self._state.v *= math.pow(self._cfg.v_decay, timestep)
-        self._state.v += self._state.a * timestep
+        self._state.v *= consts.v_decay
+        self._state.v += self._state.a * consts.timestep
         Utils.inplace_clip_by_abs(self._state.v, self._cfg.v_max)
-        self._state.p += self._state.v * timestep
-        return np.array([u1, u2, u3]) if return_urgency_vectors else None
+        self._state.p += self._state.v * consts.timestep
+        # The scratch buffer is overwritten by the next step.
+        return urgencies.copy() if return_urgency_vectors else None
+
+    def _step_particles_compiled(
+        self, consts: _StepConstants, return_urgency_vectors: bool
+    ):
+        """Like `_step_particles`, but runs the compiled kernel."""
+        sorted_p = self._scratch.sorted_p
+        radius = max(self._cfg.d_max, self._cfg.u2_dopt)
+        if radius > 0:
+            cell_list = CellList(self._state.p, radius)
+            starts, ends = cell_list.neighbor_ranges()
+            # The kernel reads neighbors in "structure of arrays"
+            # layout, sorted by cell: this is a (d, n) matrix.
+            np.take(self._state.p.T, cell_list.order, axis=1, out=sorted_p)
+        else:
+            # The first two urgencies are turned off, so no particle
+            # has any neighbor to look at.
+            starts = np.empty((self._state.p.shape[0], 0), dtype=np.int64)
+            ends = starts
+        urgencies = self._scratch.urgencies
+        self._step_kernel(
+            self._state.p,
+            self._state.v,
+            self._state.a,
+            self._state.pred_p,
+            self._uw,
+            self._scratch.eps,
+            urgencies,
+            sorted_p,
+            starts,
+            ends,
+            self._cfg.d_max,
+            self._cfg.u2_dopt,
+            self._cfg.u3_dmax,
+            consts.u_to_a,
+            self._cfg.a_max,
+            self._cfg.v_max,
+            consts.v_decay,
+            consts.timestep,
+        )
+        # The scratch buffer is overwritten by the next step.
+        return urgencies.copy() if return_urgency_vectors else None
+
+    def _step_particles_cuda(
+        self, consts: _StepConstants, return_urgency_vectors: bool
+    ):
+        """Like `_step_particles`, but runs on the GPU."""
+        self._device.step_particles(
+            self._state.pred_p,
+            d_max=self._cfg.d_max,
+            u2_dopt=self._cfg.u2_dopt,
+            u3_dmax=self._cfg.u3_dmax,
+            u_to_a=consts.u_to_a,
+            a_max=self._cfg.a_max,
+            v_max=self._cfg.v_max,
+            v_decay_factor=consts.v_decay,
+            timestep=consts.timestep,
+        )
+        return self._device.copy_urgencies_to_host() if return_urgency_vectors else None
 
     def _step_predators(self, timestep: float):
         """Execute one step of the simulation for all predators."""
@@ -168,35 +399,47 @@ class Engine:
         self._state.pred_v += self._state.pred_a * timestep
         self._state.pred_p += self._state.pred_v * timestep
 
-    def _calculate_urgency1(self, distances):
+    def _calculate_urgency1(self, pairs, __unused_distance_vectors, sq_distances, out):
         """
         Attracts each particle to the baricenter of the other particles in range.
+
+        The (n, d) result is written into `out`.
         """
-        # Select all particles that, for this component, have an
-        # effect on one another.
-        in_range = np.logical_and(distances > 0, distances <= self._cfg.d_max)
-        # To calculate the baricenter that each particle is affected
-        # by, generate a weights matrix first. This matrix embeds how
-        # much each other particle contributes to the final baricenter
-        # experienced by any given particle.
-        weights = np.zeros_like(in_range, dtype=float)
-        np.divide(
-            1.0,
-            np.count_nonzero(in_range, axis=1, keepdims=1),
-            where=in_range,
-            out=weights,
-        )
+        # Select all pairs of particles that, for this component,
+        # have an effect on one another.
+        in_range = np.logical_and(sq_distances > 0, sq_distances <= self._cfg.d_max**2)
+        i = pairs[0][in_range]
+        j = pairs[1][in_range]
+        # The baricenter that each particle is affected by is the sum
+        # of the positions of the other particles in range, divided by
+        # how many they are. Summing first and dividing once per
+        # particle avoids weighting each pair separately.
+        #
+        # Each pair is only listed once, but affects both of its
+        # particles.
+        number_of_points = self._state.p.shape[0]
+        counts = (
+            np.bincount(i, minlength=number_of_points)
+            + np.bincount(j, minlength=number_of_points)
+        ).astype(DTYPE)
+        inv_counts = np.zeros_like(counts)
+        np.reciprocal(counts, where=counts > 0, out=inv_counts)
         # Calculate the baricenter as witnessed by each particle. This
-        # is a (n, d) matrix.
-        baricenters = weights @ self._state.p
+        # is a (n, d) matrix; particles with no other particle in
+        # range see a baricenter in the origin.
+        baricenters = out
+        baricenters.fill(0.0)
+        np.add.at(baricenters, i, self._state.p[j])
+        np.add.at(baricenters, j, self._state.p[i])
+        baricenters *= inv_counts[:, np.newaxis]
         # Calculate the vector first (with epsilson)
-        u1_vector = (baricenters - self._state.p) * self._rand.gen_epsilon_matrix(
-            self._state.p.shape
-        )
+        u1_vector = baricenters
+        u1_vector -= self._state.p
+        u1_vector *= self._scratch.eps[0]
         # Multiply by the appropriate weights.
-        return u1_vector * self._cfg.u1_p * self._cfg.uw[:, 0].reshape((-1, 1))
+        u1_vector *= self._uw[:, 0:1]
 
-    def _calculate_urgency2(self, distances):
+    def _calculate_urgency2(self, pairs, distance_vectors, sq_distances, out):
         """Avoids each particle from getting too close to other particles.
 
         The strenght of this urgency is:
@@ -207,12 +450,21 @@ class Engine:
         This means that the urgency is equal to `u2_p` if
         `distance=0`, then it linearly decreases as distance
         decreases, reaching `u2_p=0` when `distance=u2_dopt.`
+
+        The (n, d) result is written into `out`.
         """
-        # Select all particles that, for this component, have an
-        # effect on one another.
-        in_range = np.logical_and(distances > 0, distances <= self._cfg.u2_dopt)
-        # Generate weights for how much each particle affects another.
-        weights = np.zeros_like(in_range, dtype=float)
+        # Select all pairs of particles that, for this component,
+        # have an effect on one another.
+        #
+        # Usually only a few pairs are this close, so they are picked
+        # by index: this is much cheaper than a boolean mask on the
+        # (k, d) distance vectors.
+        in_range = np.flatnonzero(
+            np.logical_and(sq_distances > 0, sq_distances <= self._cfg.u2_dopt**2)
+        )
+        i = pairs[0][in_range]
+        j = pairs[1][in_range]
+        distances = np.sqrt(sq_distances[in_range])
 
         # The weight modulates how strongly two particles repel one
         # another based on distance, and is equal to the following
@@ -228,50 +480,32 @@ class Engine:
         # final weight formula is:
         #
         # (u2_dopt - distance) / (u2_dopt * distance)
-        np.divide(
-            self._cfg.u2_dopt - distances,
-            self._cfg.u2_dopt * distances,
-            where=in_range,
-            out=weights,
-        )
+        weights = (self._cfg.u2_dopt - distances) / (self._cfg.u2_dopt * distances)
         # The weights need to be applied to the distance vector
-        # existing between each pair of particles. Hence, we need to
-        # compute all such vector distances.
-        #
-        # This results in a (n, n, d) matrix.
+        # existing between each pair of particles in range. This
+        # results in a (k, d) matrix.
         #
         # Note also that the difference is computed as (particle -
         # other_particle), because this is a repulsive force: the
-        # vector points from the other particle to the given one. The
-        # way which Numpy broadcasting works, this requires
-        # "extending" the first array, so we can keep `particle`
-        # constant while we "iterate" over `other_particle`.
-        distance_vectors = self._state.p[:, np.newaxis] - self._state.p
-
-        # Calculate the total effect on each particle (with
-        # epsilon). The operation applies a matrix multiplication
-        # separately on each last two dimensions. In other words:
-        #
-        # (n, a, b) * (n, b, c) -> (n, a, c)
-        #
-        # for each of the n matrices in the leftmost dimension, compute:
-        #
-        # (a, b) @ (b, c) = (a, c)
-        #
-        # See also:
-        # https://numpy.org/devdocs/reference/routines.linalg.html#linear-algebra-on-several-matrices-at-once
-        #
-        # This requires some reshaping on the fly to make dimensions work.
-        number_of_points = self._state.p.shape[0]
-        u2_vector = np.matmul(
-            weights.reshape((number_of_points, 1, number_of_points)), distance_vectors
-        ).reshape(number_of_points, -1) * self._rand.gen_epsilon_matrix(
-            self._state.p.shape
-        )
+        # vector points from the other particle to the given one.
+        distance_vectors = distance_vectors[in_range]
+
+        # Calculate the total effect on each particle (with epsilon),
+        # by summing the weighted vectors of all pairs that share the
+        # same particle. Each pair is only listed once: the other
+        # particle of the pair gets the same vector, reversed.
+        u2_vector = out
+        u2_vector.fill(0.0)
+        weighted_vectors = weights[:, np.newaxis] * distance_vectors
+        np.add.at(u2_vector, i, weighted_vectors)
+        np.subtract.at(u2_vector, j, weighted_vectors)
+        u2_vector *= self._scratch.eps[1]
         # Multiply by the appropriate weights.
-        return u2_vector * self._cfg.u2_p * self._cfg.uw[:, 1].reshape((-1, 1))
+        u2_vector *= self._uw[:, 1:2]
 
-    def _calculate_urgency3(self, __unused_distances):
+    def _calculate_urgency3(
+        self, __unused_pairs, __unused_distance_vectors, __unused_sq_distances, out
+    ):
         """Repels each particle from specially-designated "predator" particles.
 
         The strenght of this urgency is:
@@ -283,51 +517,74 @@ class Engine:
         `distance=0`, then it linearly decreases as distance
         decreases, reaching `u3_p=0` when `distance=u3_dmax.`
 
+        The (n, d) result is written into `out`.
+
         """
         # Many of the steps in this function replicate what has been
         # said in _calculate_urgency2, since they both deal with
         # repulsive forces.
         #
         # The notable difference is that the other function deals with
-        # (n, n) matrices, where `n=number of particles`, since the
-        # notable distances are all pairwise particle distances. Here,
-        # instead, we deal with (n, p) matrices, where `n` has the
-        # same meaning, and `p=numver of predators`.
-
-        # This is a (n, p) matrix.
-        distances_from_predators = scipy.spatial.distance.cdist(
-            self._state.p, self._state.pred_p
-        )
+        # pairs of nearby particles, found through a k-d tree. Here,
+        # instead, we deal with (n, p) matrices, where `n=number of
+        # particles` and `p=numver of predators`: there are usually
+        # very few predators, so all distances are computed.
+
+        # This is a (n, p) matrix, accumulated one dimension at a
+        # time to avoid building all (n, p, d) distance vectors. The
+        # differences are taken directly, instead of expanding the
+        # square: the terms of the expansion are much larger than the
+        # distances when particles are far from the origin, and in
+        # single precision they cancel out.
+        #
+        # All (n, p) matrices in this function are scratch buffers,
+        # filled in place.
+        sq_distances_from_predators = self._scratch.pred_sq_distances
+        sq_distances_from_predators.fill(0.0)
+        diff = self._scratch.pred_diff
+        for dim in range(self._state.p.shape[1]):
+            np.subtract(
+                self._state.p[:, dim, np.newaxis], self._state.pred_p[:, dim], out=diff
+            )
+            np.square(diff, out=diff)
+            sq_distances_from_predators += diff
         # Select all particles that, for this component, are affected
         # by a predator.
-        in_range = np.logical_and(
-            distances_from_predators > 0, distances_from_predators <= self._cfg.u3_dmax
+        in_range = self._scratch.pred_in_range
+        np.greater(sq_distances_from_predators, 0.0, out=in_range)
+        np.less_equal(
+            sq_distances_from_predators,
+            self._cfg.u3_dmax**2,
+            out=self._scratch.pred_mask,
         )
-        # Generate weights for how much each particle is affected.
-        weights = np.zeros_like(in_range, dtype=float)
-        np.divide(
-            self._cfg.u3_dmax - distances_from_predators,
-            self._cfg.u3_dmax * distances_from_predators,
-            where=in_range,
-            out=weights,
+        np.logical_and(in_range, self._scratch.pred_mask, out=in_range)
+        # Only the distances in range are needed.
+        distances_from_predators = self._scratch.pred_distances
+        distances_from_predators.fill(0.0)
+        np.sqrt(
+            sq_distances_from_predators, where=in_range, out=distances_from_predators
         )
-
-        # This is a (n, p, d) matrix. This is computed as (particle -
-        # predator) for the same reasons that apply to the similar
-        # computation in _calculate_urgency2.
-        distance_vectors = self._state.p[:, np.newaxis] - self._state.pred_p
-
-        # The goal is to generate a u3_vector that is (n, d) in shape,
-        # performing the matmul magic:
-        #
-        # (n, 1, p) * (n, p, d) = (n, 1, d)
-        number_of_points = self._state.p.shape[0]
-        number_of_predators = self._state.pred_p.shape[0]
-        u3_vector = np.matmul(
-            weights.reshape((number_of_points, 1, number_of_predators)),
-            distance_vectors,
-        ).reshape(number_of_points, -1) * self._rand.gen_epsilon_matrix(
-            self._state.p.shape
+        # Generate weights for how much each particle is affected,
+        # i.e. (u3_dmax - distance) / (u3_dmax * distance).
+        weights = self._scratch.pred_weights
+        weights.fill(0.0)
+        np.subtract(
+            self._cfg.u3_dmax, distances_from_predators, where=in_range, out=weights
         )
+        np.divide(weights, distances_from_predators, where=in_range, out=weights)
+        weights /= self._cfg.u3_dmax
+
+        # The weights need to be applied to the distance vectors
+        # (particle - predator), for the same reasons that apply to
+        # the similar computation in _calculate_urgency2. These are
+        # again taken one dimension at a time, and each column of the
+        # (n, d) result is a weighted sum over the predators.
+        u3_vector = out
+        for dim in range(self._state.p.shape[1]):
+            np.subtract(
+                self._state.p[:, dim, np.newaxis], self._state.pred_p[:, dim], out=diff
+            )
+            np.einsum("ij,ij->i", weights, diff, out=u3_vector[:, dim])
+        u3_vector *= self._scratch.eps[2]
         # Multiply by the appropriate weights.
-        return u3_vector * self._cfg.u3_p * self._cfg.uw[:, 2].reshape((-1, 1))
+        u3_vector *= self._uw[:, 2:3]
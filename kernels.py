@@ -0,0 +1,392 @@
+#!/usr/bin/python3
+#
+#  Simulate and display movement of particles in a system
+#  Copyright (C) 2024  Marco Leogrande
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# Compiled versions of the hot loops of the engine. This module
+# requires `numba`; the engine falls back to plain `numpy` if it
+# cannot be imported.
+
+import math
+import numba
+import numpy as np
+
+
+@numba.njit(parallel=True, fastmath=True, error_model="numpy", cache=True)
+def step_particles(
+    p,
+    v,
+    a,
+    pred_p,
+    uw,
+    eps,
+    u,
+    sorted_p,
+    starts,
+    ends,
+    d_max,
+    u2_dopt,
+    u3_dmax,
+    u_to_a,
+    a_max,
+    v_max,
+    v_decay_factor,
+    timestep,
+):
+    """Execute one step of the simulation for all particles.
+
+    This is the same math as `Engine._step_particles`, with all
+    urgencies computed in a single pass over the neighbors of each
+    particle (as returned by `CellList.neighbor_ranges`) and without
+    any temporary matrix.
+
+    Neighbors are read from `sorted_p`, a (d, n) matrix with the
+    positions of all particles in `CellList.order`: the particles in
+    each cell are then contiguous along each row, and each coordinate
+    can be streamed separately.
+
+    `uw` is a (n, 3) matrix with the urgency weights of each
+    particle, already multiplied by the linear parameter of each
+    urgency component. `u_to_a` converts urgencies to accelerations
+    (i.e. `a_max / u_max`), and `v_decay_factor` is the velocity decay
+    over a whole `timestep` (i.e. `v_decay**timestep`). `eps` is a
+    (4, n, d) matrix with the epsilon for the three urgencies and for
+    the final acceleration. The (3, n, d) matrix `u` is overwritten
+    with the three urgencies.
+    """
+    number_of_points, dimensions = p.shape
+    number_of_predators = pred_p.shape[0]
+    d_max_sq = d_max * d_max
+    u2_dopt_sq = u2_dopt * u2_dopt
+    u3_dmax_sq = u3_dmax * u3_dmax
+
+    # Calculate every single urgency. Positions are only read here,
+    # so each particle can be processed in parallel.
+    for i in numba.prange(number_of_points):
+        for k in range(dimensions):
+            u[0, i, k] = 0.0
+            u[1, i, k] = 0.0
+            u[2, i, k] = 0.0
+        count = 0
+        for c in range(starts.shape[1]):
+            for s in range(starts[i, c], ends[i, c]):
+                sq_distance = 0.0
+                for k in range(dimensions):
+                    diff = p[i, k] - sorted_p[k, s]
+                    sq_distance += diff * diff
+                if sq_distance <= 0.0:
+                    continue
+                if sq_distance <= d_max_sq:
+                    # Accumulate the baricenter in u[0].
+                    count += 1
+                    for k in range(dimensions):
+                        u[0, i, k] += sorted_p[k, s]
+                if sq_distance <= u2_dopt_sq:
+                    distance = math.sqrt(sq_distance)
+                    weight = (u2_dopt - distance) / (u2_dopt * distance)
+                    for k in range(dimensions):
+                        u[1, i, k] += weight * (p[i, k] - sorted_p[k, s])
+        for q in range(number_of_predators):
+            sq_distance = 0.0
+            for k in range(dimensions):
+                diff = p[i, k] - pred_p[q, k]
+                sq_distance += diff * diff
+            if sq_distance <= 0.0 or sq_distance > u3_dmax_sq:
+                continue
+            distance = math.sqrt(sq_distance)
+            weight = (u3_dmax - distance) / (u3_dmax * distance)
+            for k in range(dimensions):
+                u[2, i, k] += weight * (p[i, k] - pred_p[q, k])
+        # Particles with no other particle in range see a baricenter
+        # in the origin.
+        inv_count = 1.0 / count if count > 0 else 0.0
+        for k in range(dimensions):
+            u[0, i, k] = (u[0, i, k] * inv_count - p[i, k]) * eps[0, i, k] * uw[i, 0]
+            u[1, i, k] *= eps[1, i, k] * uw[i, 1]
+            u[2, i, k] *= eps[2, i, k] * uw[i, 2]
+
+    # Edit acceleration, velocity and position state accordingly.
+    _integrate(p, v, a, eps, u, u_to_a, a_max, v_max, v_decay_factor, timestep)
+
+
+@numba.njit(parallel=True, fastmath=True, error_model="numpy", cache=True)
+def _integrate(p, v, a, eps, u, u_to_a, a_max, v_max, v_decay_factor, timestep):
+    """Edit acceleration, velocity and position of each particle.
+
+    `u` are the urgencies computed by one of the `step_particles*`
+    kernels; all other parameters are the same as theirs.
+    """
+    number_of_points, dimensions = p.shape
+    for i in numba.prange(number_of_points):
+        sum_of_squares = 0.0
+        for k in range(dimensions):
+            a[i, k] = (u[0, i, k] + u[1, i, k] + u[2, i, k]) * u_to_a
+            sum_of_squares += a[i, k] * a[i, k]
+        # Rows longer than a_max are scaled down to a_max.
+        # Only those are divided, so that zero rows stay zero when the
+        # limit is 0.
+        norm = math.sqrt(sum_of_squares)
+        scale = 1.0 if norm <= a_max else a_max / norm
+        sum_of_squares = 0.0
+        for k in range(dimensions):
+            a[i, k] *= scale * eps[3, i, k]
+            v[i, k] = v[i, k] * v_decay_factor + a[i, k] * timestep
+            sum_of_squares += v[i, k] * v[i, k]
+        # Rows longer than v_max are scaled down to v_max.
+        norm = math.sqrt(sum_of_squares)
+        scale = 1.0 if norm <= v_max else v_max / norm
+        for k in range(dimensions):
+            v[i, k] *= scale
+            p[i, k] += v[i, k] * timestep
+
+
+@numba.njit(parallel=True, fastmath=True, error_model="numpy", cache=True)
+def step_particles_2d(
+    p,
+    v,
+    a,
+    pred_p,
+    uw,
+    eps,
+    u,
+    sorted_p,
+    starts,
+    ends,
+    d_max,
+    u2_dopt,
+    u3_dmax,
+    u_to_a,
+    a_max,
+    v_max,
+    v_decay_factor,
+    timestep,
+):
+    """Same as `step_particles`, for 2-dimensional positions only.
+
+    The loops over the dimensions are unrolled by hand, and all sums
+    are kept in local variables instead of in `u`: this way, they can
+    stay in registers for the whole walk over the neighbors.
+    """
+    number_of_points = p.shape[0]
+    number_of_predators = pred_p.shape[0]
+    d_max_sq = d_max * d_max
+    u2_dopt_sq = u2_dopt * u2_dopt
+    u3_dmax_sq = u3_dmax * u3_dmax
+
+    for i in numba.prange(number_of_points):
+        p_x = p[i, 0]
+        p_y = p[i, 1]
+        # Sums of the positions of the particles in range (for the
+        # baricenter), and of the weighted vectors away from the
+        # other particles and from the predators.
+        baricenter_x = 0.0
+        baricenter_y = 0.0
+        repulsion_x = 0.0
+        repulsion_y = 0.0
+        escape_x = 0.0
+        escape_y = 0.0
+        count = 0
+        for c in range(starts.shape[1]):
+            for s in range(starts[i, c], ends[i, c]):
+                dx = p_x - sorted_p[0, s]
+                dy = p_y - sorted_p[1, s]
+                sq_distance = dx * dx + dy * dy
+                if sq_distance <= 0.0:
+                    continue
+                if sq_distance <= d_max_sq:
+                    count += 1
+                    baricenter_x += sorted_p[0, s]
+                    baricenter_y += sorted_p[1, s]
+                if sq_distance <= u2_dopt_sq:
+                    distance = math.sqrt(sq_distance)
+                    weight = (u2_dopt - distance) / (u2_dopt * distance)
+                    repulsion_x += weight * dx
+                    repulsion_y += weight * dy
+        for q in range(number_of_predators):
+            dx = p_x - pred_p[q, 0]
+            dy = p_y - pred_p[q, 1]
+            sq_distance = dx * dx + dy * dy
+            if sq_distance <= 0.0 or sq_distance > u3_dmax_sq:
+                continue
+            distance = math.sqrt(sq_distance)
+            weight = (u3_dmax - distance) / (u3_dmax * distance)
+            escape_x += weight * dx
+            escape_y += weight * dy
+        # Particles with no other particle in range see a baricenter
+        # in the origin.
+        inv_count = 1.0 / count if count > 0 else 0.0
+        u[0, i, 0] = (baricenter_x * inv_count - p_x) * eps[0, i, 0] * uw[i, 0]
+        u[0, i, 1] = (baricenter_y * inv_count - p_y) * eps[0, i, 1] * uw[i, 0]
+        u[1, i, 0] = repulsion_x * eps[1, i, 0] * uw[i, 1]
+        u[1, i, 1] = repulsion_y * eps[1, i, 1] * uw[i, 1]
+        u[2, i, 0] = escape_x * eps[2, i, 0] * uw[i, 2]
+        u[2, i, 1] = escape_y * eps[2, i, 1] * uw[i, 2]
+
+    _integrate(p, v, a, eps, u, u_to_a, a_max, v_max, v_decay_factor, timestep)
+
+
+@numba.njit(parallel=True, fastmath=True, error_model="numpy", cache=True)
+def step_particles_3d(
+    p,
+    v,
+    a,
+    pred_p,
+    uw,
+    eps,
+    u,
+    sorted_p,
+    starts,
+    ends,
+    d_max,
+    u2_dopt,
+    u3_dmax,
+    u_to_a,
+    a_max,
+    v_max,
+    v_decay_factor,
+    timestep,
+):
+    """Same as `step_particles`, for 3-dimensional positions only.
+
+    The loops over the dimensions are unrolled by hand, and all sums
+    are kept in local variables instead of in `u`: this way, they can
+    stay in registers for the whole walk over the neighbors.
+    """
+    number_of_points = p.shape[0]
+    number_of_predators = pred_p.shape[0]
+    d_max_sq = d_max * d_max
+    u2_dopt_sq = u2_dopt * u2_dopt
+    u3_dmax_sq = u3_dmax * u3_dmax
+
+    for i in numba.prange(number_of_points):
+        p_x = p[i, 0]
+        p_y = p[i, 1]
+        p_z = p[i, 2]
+        # Sums of the positions of the particles in range (for the
+        # baricenter), and of the weighted vectors away from the
+        # other particles and from the predators.
+        baricenter_x = 0.0
+        baricenter_y = 0.0
+        baricenter_z = 0.0
+        repulsion_x = 0.0
+        repulsion_y = 0.0
+        repulsion_z = 0.0
+        escape_x = 0.0
+        escape_y = 0.0
+        escape_z = 0.0
+        count = 0
+        for c in range(starts.shape[1]):
+            for s in range(starts[i, c], ends[i, c]):
+                dx = p_x - sorted_p[0, s]
+                dy = p_y - sorted_p[1, s]
+                dz = p_z - sorted_p[2, s]
+                sq_distance = dx * dx + dy * dy + dz * dz
+                if sq_distance <= 0.0:
+                    continue
+                if sq_distance <= d_max_sq:
+                    count += 1
+                    baricenter_x += sorted_p[0, s]
+                    baricenter_y += sorted_p[1, s]
+                    baricenter_z += sorted_p[2, s]
+                if sq_distance <= u2_dopt_sq:
+                    distance = math.sqrt(sq_distance)
+                    weight = (u2_dopt - distance) / (u2_dopt * distance)
+                    repulsion_x += weight * dx
+                    repulsion_y += weight * dy
+                    repulsion_z += weight * dz
+        for q in range(number_of_predators):
+            dx = p_x - pred_p[q, 0]
+            dy = p_y - pred_p[q, 1]
+            dz = p_z - pred_p[q, 2]
+            sq_distance = dx * dx + dy * dy + dz * dz
+            if sq_distance <= 0.0 or sq_distance > u3_dmax_sq:
+                continue
+            distance = math.sqrt(sq_distance)
+            weight = (u3_dmax - distance) / (u3_dmax * distance)
+            escape_x += weight * dx
+            escape_y += weight * dy
+            escape_z += weight * dz
+        # Particles with no other particle in range see a baricenter
+        # in the origin.
+        inv_count = 1.0 / count if count > 0 else 0.0
+        u[0, i, 0] = (baricenter_x * inv_count - p_x) * eps[0, i, 0] * uw[i, 0]
+        u[0, i, 1] = (baricenter_y * inv_count - p_y) * eps[0, i, 1] * uw[i, 0]
+        u[0, i, 2] = (baricenter_z * inv_count - p_z) * eps[0, i, 2] * uw[i, 0]
+        u[1, i, 0] = repulsion_x * eps[1, i, 0] * uw[i, 1]
+        u[1, i, 1] = repulsion_y * eps[1, i, 1] * uw[i, 1]
+        u[1, i, 2] = repulsion_z * eps[1, i, 2] * uw[i, 1]
+        u[2, i, 0] = escape_x * eps[2, i, 0] * uw[i, 2]
+        u[2, i, 1] = escape_y * eps[2, i, 1] * uw[i, 2]
+        u[2, i, 2] = escape_z * eps[2, i, 2] * uw[i, 2]
+
+    _integrate(p, v, a, eps, u, u_to_a, a_max, v_max, v_decay_factor, timestep)
+
+
+@numba.njit(cache=True)
+def _find_cell(cells, m, offset):
+    """Returns the index of the cell `cells[m] + offset` in `cells`.
+
+    `cells` is a (m, d) matrix of cell coordinates, in lexicographic
+    order. If the cell is not there, the result is -1.
+    """
+    low = 0
+    high = cells.shape[0]
+    while low < high:
+        mid = (low + high) // 2
+        # Compare cells[mid] with the cell being searched.
+        comparison = 0
+        for k in range(cells.shape[1]):
+            coord = cells[m, k] + offset[k]
+            if cells[mid, k] != coord:
+                comparison = -1 if cells[mid, k] < coord else 1
+                break
+        if comparison == 0:
+            return mid
+        if comparison < 0:
+            low = mid + 1
+        else:
+            high = mid
+    return -1
+
+
+@numba.njit(parallel=True, cache=True)
+def neighbor_ranges(occupied_cells, cell_starts, order, offsets, starts, ends):
+    """Fill `starts` and `ends` as returned by `CellList.neighbor_ranges`.
+
+    `occupied_cells` is the (m, d) matrix of the coordinates of the
+    occupied cells, in lexicographic order, and the particles in cell
+    `m` are `order[cell_starts[m]:cell_starts[m + 1]]`. `offsets` are
+    the (3^d, d) offsets of the cells around a cell.
+    """
+    # All particles in the same cell have the same neighbor cells, so
+    # the ranges are only searched once per cell, for its first
+    # particle, then copied to the others.
+    for m in numba.prange(occupied_cells.shape[0]):
+        i_first = order[cell_starts[m]]
+        for c in range(offsets.shape[0]):
+            neighbor = _find_cell(occupied_cells, m, offsets[c])
+            if neighbor < 0:
+                starts[i_first, c] = 0
+                ends[i_first, c] = 0
+            else:
+                starts[i_first, c] = cell_starts[neighbor]
+                ends[i_first, c] = cell_starts[neighbor + 1]
+        for r in range(cell_starts[m] + 1, cell_starts[m + 1]):
+            i = order[r]
+            for c in range(offsets.shape[0]):
+                starts[i, c] = starts[i_first, c]
+                ends[i, c] = ends[i_first, c]
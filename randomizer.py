@@ -26,13 +26,22 @@ SEED = 133713371337
 
 
 class Randomizer:
-    def __init__(self):
+    def __init__(self, dtype: np.typing.DTypeLike = np.float64):
         self._rng = np.random.default_rng(seed=SEED)
+        self._dtype = dtype
 
     def gen_epsilon_matrix(self, shape: Tuple):
         return self.gen_random_matrix(
             shape, min_value=1.0 - EPSILON, max_value=1.0 + EPSILON
         )
 
+    def fill_epsilon_matrix(self, out: np.typing.NDArray):
+        """Like `gen_epsilon_matrix`, but fills `out` in place."""
+        self._rng.random(out=out, dtype=out.dtype)
+        out *= 2 * EPSILON
+        out += 1.0 - EPSILON
+
     def gen_random_matrix(self, shape: Tuple, *, min_value: float, max_value: float):
-        return (max_value - min_value) * self._rng.random(size=shape) + min_value
+        return (max_value - min_value) * self._rng.random(
+            size=shape, dtype=self._dtype
+        ) + min_value
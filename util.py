@@ -24,11 +24,14 @@ from typing import List, Tuple
 class Utils:
     def inplace_clip_by_abs(input: np.typing.NDArray, max_abs: float):
         """Clips row values of a (n, d) matrix so that abs(row)<=max_abs."""
-        sum_of_squares = np.sum(input**2, axis=1, keepdims=1)
-        clipped = sum_of_squares > (max_abs**2)
-        scale_factors = np.ones_like(sum_of_squares)
-        scale_factors[clipped] = np.sqrt(sum_of_squares[clipped]) / max_abs
-        np.divide(input, scale_factors, out=input, where=clipped)
+        # Rows longer than max_abs are scaled by max_abs/abs(row), the
+        # others by 1. Only the former are divided, so that there is no
+        # 0/0 for zero rows when max_abs is 0.
+        abs_rows = np.sqrt(np.einsum("ij,ij->i", input, input))
+        scale = np.divide(
+            max_abs, abs_rows, out=np.ones_like(abs_rows), where=abs_rows > max_abs
+        )
+        input *= scale[:, np.newaxis]
 
     def repack_particle_histories_for_manim(
         state_history: "List[State]",